@@ -176,6 +176,9 @@ async def stream_chat(request: ChatRequest) -> StreamingResponse:
         async for response in agent_service.process_chat_message(request):
             yield f"data: {response.model_dump_json()}\n\n"
 
+    # Each yielded frame is sent as its own ASGI body message, and asyncio/uvloop transports
+    # enable TCP_NODELAY on accepted sockets, so frames are written without Nagle delays.
+    # Keep X-Accel-Buffering off so proxies don't re-buffer the stream.
     return StreamingResponse(
         generate_stream(),
         media_type="text/event-stream",
@@ -5,36 +5,45 @@ Contains the AgentService class for handling chat message processing
 and streaming responses.
 """
 
+from __future__ import annotations
+
 import asyncio
 import contextlib
 import logging
-from datetime import datetime
-from typing import AsyncGenerator, Dict, Protocol, cast
-
-from azure.ai.agents.aio import AgentsClient
-from azure.ai.agents.models import (
-    Agent,
-    AgentThread,
-    AsyncToolSet,
-    MCPToolResource,
-    RunCompletionUsage,
-    ToolResources,
-    TruncationObject,
-    TruncationStrategy,
-)
-from azure.ai.projects.aio import AIProjectClient
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Coroutine, Dict, Iterator, Protocol
+
+from azure.ai.agents.models import MCPToolResource, ToolResources, TruncationObject, TruncationStrategy
 from config import Config
 from opentelemetry import trace
 from pydantic import BaseModel
-from stream_event_handler import WebStreamEventHandler
+from stream_event_handler import StreamItemType, WebStreamEventHandler
 from utilities import Utilities
 
+if TYPE_CHECKING:
+    # Only needed for type hints
+    from azure.ai.agents.aio import AgentsClient
+    from azure.ai.agents.models import Agent, AgentThread, AsyncToolSet, RunCompletionUsage
+    from azure.ai.projects.aio import AIProjectClient
+
 # Get tracer instance
 tracer = trace.get_tracer("zava_agent.tracing")
 logger = logging.getLogger(__name__)
 
 config = Config()
 
+# Session access counters are halved on every eviction, and whenever one passes this value
+SESSION_COUNTER_SATURATION = 1 << 10
+
+# Give up on cancelling a failed run after this long
+RUN_CANCEL_TIMEOUT_SECONDS = 5.0
+
+# Upper bound on text merged into a single streamed response
+MAX_COALESCED_TEXT = 4096
+
+# Footer appended to each response with the run's token usage
+_USAGE_FMT = "</br></br>Token usage: Prompt: {}, Completion: {}, Total: {}".format
+
 
 class AgentManagerProtocol(Protocol):
     """Protocol for AgentManager to avoid circular imports."""
@@ -63,20 +72,46 @@ class ChatResponse(BaseModel):
     done: bool = False
 
 
+def _tracing_enabled() -> bool:
+    """Check whether a real tracer provider has been configured (by configure_azure_monitor at startup)."""
+    return not isinstance(trace.get_tracer_provider(), (trace.ProxyTracerProvider, trace.NoOpTracerProvider))
+
+
 class ChatManager:
     """REST API service for the Azure AI Agent."""
 
+    mcp_server_label = "ZavaSalesAnalysisMcpServer"
+    mcp_require_approval = "never"
+
     def __init__(self, agent_manager: AgentManagerProtocol) -> None:
         self.agent_manager = agent_manager
         self.utilities = Utilities()
-        self.session_threads: Dict[str, AgentThread] = {}
+        # Limit context to last 5 messages (instead of default auto truncation)
+        self.truncation_strategy = TruncationObject(
+            type=TruncationStrategy.LAST_MESSAGES,  # or "last_messages"
+            last_messages=5,
+        )
+        self.session_threads: OrderedDict[str, AgentThread] = OrderedDict()
+        self._session_counters: Dict[str, int] = {}
+        # Sessions with a chat request in progress; never evicted while their run is streaming
+        self._sessions_in_use: Dict[str, int] = {}
+        self._cleanup_tasks: set[asyncio.Task] = set()
         self._session_lock = asyncio.Lock()
 
     async def get_or_create_thread(self, session_id: str) -> AgentThread:
         """Get existing thread for session or create a new one."""
+        # Fast path: a hit only does synchronous bookkeeping, so it is safe without the lock
+        thread = self.session_threads.get(session_id)
+        if thread is not None:
+            self._touch_session(session_id)
+            return thread
+
         async with self._session_lock:
-            if session_id in self.session_threads:
-                return self.session_threads[session_id]
+            # Another request may have created the thread while we waited for the lock
+            thread = self.session_threads.get(session_id)
+            if thread is not None:
+                self._touch_session(session_id)
+                return thread
 
             if not self.agent_manager.agents_client:
                 raise ValueError("AgentsClient is not initialized")
@@ -86,21 +121,103 @@ class ChatManager:
             self.session_threads[session_id] = thread
             logger.info("Created new thread %s for session %s", thread.id, session_id)
 
+            # Keep the number of cached threads bounded, only once the new thread exists
+            while len(self.session_threads) > config.max_sessions:
+                if not self._evict_session(keep=session_id):
+                    break
+            # Start counting after any aging so a new session is not halved before its first reuse
+            if config.session_eviction_policy == "counter":
+                self._session_counters[session_id] = 1
+
             return thread
 
+    def _touch_session(self, session_id: str) -> None:
+        """Record an access to a session for the eviction policy."""
+        if config.session_eviction_policy == "counter":
+            count = self._session_counters[session_id] + 1
+            self._session_counters[session_id] = count
+            if count > SESSION_COUNTER_SATURATION:
+                self._age_session_counters()
+        else:
+            self.session_threads.move_to_end(session_id)
+
+    def _age_session_counters(self) -> None:
+        """Halve all access counters so sessions that were busy long ago can be evicted."""
+        self._session_counters = {k: v >> 1 for k, v in self._session_counters.items()}
+
+    def _evict_session(self, keep: str) -> bool:
+        """Evict one idle session thread and delete it from the service in the background.
+
+        Returns False if every other cached session is busy and nothing was evicted.
+        """
+        idle = (sid for sid in self.session_threads if sid != keep and sid not in self._sessions_in_use)
+        if config.session_eviction_policy == "counter":
+            session_id = min(idle, key=self._session_counters.__getitem__, default=None)
+        else:
+            # Iteration order is least recently used first
+            session_id = next(idle, None)
+
+        if session_id is None:
+            # Every other cached session is streaming; the next insertion trims the cache again
+            logger.warning("⚠️ No idle session to evict, %d sessions cached", len(self.session_threads))
+            return False
+
+        thread = self.session_threads.pop(session_id)
+        if config.session_eviction_policy == "counter":
+            del self._session_counters[session_id]
+            self._age_session_counters()
+        logger.info("Evicting thread %s for session %s", thread.id, session_id)
+        self._spawn_cleanup(self._delete_thread(thread.id))
+        return True
+
+    def _spawn_cleanup(self, coro: Coroutine[Any, Any, None]) -> None:
+        """Run a cleanup call in the background, holding a reference until it finishes."""
+        task = asyncio.create_task(coro)
+        self._cleanup_tasks.add(task)
+        task.add_done_callback(self._cleanup_tasks.discard)
+
+    async def _delete_thread(self, thread_id: str) -> None:
+        """Delete a thread, logging rather than raising on failure."""
+        if not self.agent_manager.agents_client:
+            return
+        try:
+            await self.agent_manager.agents_client.threads.delete(thread_id)
+        except Exception as e:
+            logger.warning("⚠️ Failed to delete evicted thread %s: %s", thread_id, e)
+
+    async def _cancel_run(self, agents_client: AgentsClient, thread_id: str, run_id: str) -> None:
+        """Cancel a failed run, logging rather than raising on failure."""
+        try:
+            await asyncio.wait_for(
+                agents_client.runs.cancel(thread_id=thread_id, run_id=run_id), RUN_CANCEL_TIMEOUT_SECONDS
+            )
+        except Exception as e:
+            logger.warning("⚠️ Failed to cancel run %s: %s", run_id, e)
+
+    @contextlib.contextmanager
+    def _session_in_use(self, session_id: str) -> Iterator[None]:
+        """Mark a session as busy so its thread is not evicted while a request uses it."""
+        self._sessions_in_use[session_id] = self._sessions_in_use.get(session_id, 0) + 1
+        try:
+            yield
+        finally:
+            remaining = self._sessions_in_use.pop(session_id) - 1
+            if remaining:
+                self._sessions_in_use[session_id] = remaining
+
     async def clear_session_thread(self, session_id: str) -> None:
         """Clear thread for a specific session."""
         async with self._session_lock:
             if session_id in self.session_threads:
-                thread = self.session_threads[session_id]
+                # Remove the entry first so lock-free lookups never return a thread being deleted
+                thread = self.session_threads.pop(session_id)
+                self._session_counters.pop(session_id, None)
                 if self.agent_manager.agents_client and self.agent_manager.agent:
                     with tracer.start_as_current_span("Zava Agent Chat Thread Deletion") as span:
                         await self.agent_manager.agents_client.threads.delete(thread.id)
                         span.set_attribute("thread_id", thread.id)
                         span.set_attribute("session_id", session_id)
                         span.set_attribute("agent_id", self.agent_manager.agent.id)
-                        span.set_attribute("date_time", datetime.now().isoformat())
-                del self.session_threads[session_id]
 
         logger.info("Cleared thread for session %s", session_id)
 
@@ -110,7 +227,8 @@ class ChatManager:
         run_status = None
         incomplete_details = None
 
-        if not request.message.strip():
+        message = request.message
+        if not message.strip():
             yield ChatResponse(error="Empty message")
             return
 
@@ -122,70 +240,66 @@ class ChatManager:
             yield ChatResponse(error="Agent not initialized")
             return
 
-        # Type guards - ensure all required components are available
-        if not self.agent_manager.agents_client or not self.agent_manager.agent:
+        # Type guards - ensure all required components are available, bound once as locals
+        agents_client = self.agent_manager.agents_client
+        agent = self.agent_manager.agent
+        if not agents_client or not agent:
             yield ChatResponse(error="Agent components not properly initialized")
             return
 
-        # Create a span for this chat request
-        message_preview = request.message[:50] + "..." if len(request.message) > 50 else request.message
-        span_name = f"Zava Agent Chat Request: {message_preview}"
+        # Create a span for this chat request, skipping span setup when tracing is not configured
+        if _tracing_enabled():
+            message_preview = message[:50] + ("..." if len(message) > 50 else "")
+            span_context = tracer.start_as_current_span(f"Zava Agent Chat Request: {message_preview}")
+        else:
+            span_context = contextlib.nullcontext(trace.INVALID_SPAN)
 
-        with tracer.start_as_current_span(span_name) as span:
+        session_id = request.session_id or "default"
+        with span_context as span, self._session_in_use(session_id):
             try:
                 # Get or create thread for this session
-                session_id = request.session_id or "default"
                 session_thread = await self.get_or_create_thread(session_id)
 
-                web_handler = None
-                stream_task = None
-
                 # Create the web streaming event handler with proper resource management
-                web_handler = WebStreamEventHandler(self.utilities, self.agent_manager.agents_client)
+                web_handler = WebStreamEventHandler(self.utilities, agents_client)
 
                 # Add some attributes to the span for better observability
-                span.set_attribute("user_message", request.message)
-                span.set_attribute("operation_type", "chat_request")
-                span.set_attribute("agent_id", self.agent_manager.agent.id)
-                span.set_attribute("thread_id", session_thread.id)
-                span.set_attribute("session_id", session_id)
-                span.set_attribute("rls_user_id", request.rls_user_id)
+                span.set_attributes(
+                    {
+                        "user_message": message,
+                        "operation_type": "chat_request",
+                        "agent_id": agent.id,
+                        "thread_id": session_thread.id,
+                        "session_id": session_id,
+                        "rls_user_id": request.rls_user_id,
+                    }
+                )
 
                 # Create message in thread
 
-                await self.agent_manager.agents_client.messages.create(
+                await agents_client.messages.create(
                     thread_id=session_thread.id,
                     role="user",
-                    content=request.message,
+                    content=message,
                 )
 
-                # Start the stream in a background task
-                async def run_stream() -> None:
-                    # Capture references with type casts since we've already checked they're not None
-                    agents_client = cast(AgentsClient, self.agent_manager.agents_client)
-                    agent = cast(Agent, self.agent_manager.agent)
-                    thread = session_thread  # Use the session-specific thread
-
-                    # Limit context to last 5 messages (instead of default auto truncation)
-                    truncation_strategy = TruncationObject(
-                        type=TruncationStrategy.LAST_MESSAGES,  # or "last_messages"
-                        last_messages=5,
-                    )
-
-                    tool_resources = ToolResources()
+                tool_resources = ToolResources()
 
-                    if request.rls_user_id:
-                        # Create dynamic tool resources with RLS user ID header
-                        mcp_tool_resource = MCPToolResource(
-                            server_label="ZavaSalesAnalysisMcpServer",
-                            headers={"x-rls-user-id": request.rls_user_id},
-                            require_approval="never",
-                        )
-                        tool_resources.mcp = [mcp_tool_resource]
+                if request.rls_user_id:
+                    # Create dynamic tool resources with RLS user ID header
+                    mcp_tool_resource = MCPToolResource(
+                        server_label=self.mcp_server_label,
+                        headers={"x-rls-user-id": request.rls_user_id},
+                        require_approval=self.mcp_require_approval,
+                    )
+                    tool_resources.mcp = [mcp_tool_resource]
 
-                    try:
-                        async with await agents_client.runs.stream(
-                            thread_id=thread.id,
+                try:
+                    async with (
+                        # Entered first so opening the run stream is also bounded by the response timeout
+                        asyncio.timeout(config.response_timeout_seconds) as deadline,
+                        await agents_client.runs.stream(
+                            thread_id=session_thread.id,
                             agent_id=agent.id,
                             event_handler=web_handler,
                             max_completion_tokens=config.max_completion_tokens,
@@ -193,86 +307,68 @@ class ChatManager:
                             temperature=config.temperature,
                             top_p=config.top_p,
                             tool_resources=tool_resources,
-                            truncation_strategy=truncation_strategy,
-                        ) as stream:
-                            await stream.until_done()
-
-                        # Update the method-level variables
-                        nonlocal usage, run_status, incomplete_details
-                        usage = web_handler.usage
-                        run_status = web_handler.run_status
-                        incomplete_details = web_handler.incomplete_details
-
-                    except Exception as e:
-                        # cancel the run if it fails
-                        if web_handler.run_id:
-                            try:
-                                await agents_client.runs.cancel(thread_id=thread.id, run_id=web_handler.run_id)
-                            except Exception as cancel_error:
-                                logger.warning("⚠️ Failed to cancel run %s: %s", web_handler.run_id, cancel_error)
-                        logger.error("❌ Error in agent stream: %s", e)
-                        # Send error to client safely
-                        await web_handler.put_safely({"type": "error", "error": str(e)})
-                        span.set_attribute("error", True)
-                        span.set_attribute("error_message", str(e))
-                    finally:
-                        # Signal end of stream safely
-                        await web_handler.put_safely(None)
-
-                # Start the stream task
-                stream_task = asyncio.create_task(run_stream())
-
-                # Stream tokens as they arrive
-                try:
-                    while True:
-                        try:
-                            # Monitor queue health
-                            queue_size = web_handler.get_queue_size()
-                            if queue_size > 100:  # Warn if queue gets too large
-                                logger.warning("⚠️ Token queue size is large: %d", queue_size)
-
-                            # Wait for next token with timeout
-                            item = await asyncio.wait_for(
-                                web_handler.token_queue.get(), timeout=config.response_timeout_seconds
-                            )
-                            if item is None:  # End of stream signal
-                                break
-
-                            # Yield response based on type
-                            if isinstance(item, dict):
-                                if item.get("type") == "text":
-                                    yield ChatResponse(content=item["content"])
-                                elif item.get("type") == "file":
-                                    yield ChatResponse(file_info=item["file_info"])
-                                elif item.get("type") == "error":
-                                    yield ChatResponse(error=item["error"])
-                            else:
-                                # Backwards compatibility for plain text
-                                yield ChatResponse(content=str(item))
-
-                        except asyncio.TimeoutError:
-                            yield ChatResponse(
-                                error=f"Response timeout after {config.response_timeout_seconds} seconds"
-                            )
-                            break
+                            truncation_strategy=self.truncation_strategy,
+                        ) as stream,
+                    ):
+                        # Pump the stream from this generator: each event runs the handler callbacks,
+                        # which collect their output for us to drain without waiting. Only the waits
+                        # for events are timed, not the client consuming our output.
+                        loop = asyncio.get_running_loop()
+                        deadline.reschedule(loop.time() + config.response_timeout_seconds)
+                        async for _ in stream:
+                            # Also run events the SDK has already received, so their text goes out
+                            # as one response instead of one response per event
+                            while (
+                                web_handler.pending_text_size < MAX_COALESCED_TEXT and web_handler.has_buffered_event()
+                            ):
+                                await anext(stream)
+                            deadline.reschedule(None)
+
+                            pending_text = ""
+                            for tag, payload in web_handler.drain():
+                                if tag is StreamItemType.TEXT:
+                                    # Coalesce adjacent text items into one response
+                                    pending_text += payload
+                                    if len(pending_text) >= MAX_COALESCED_TEXT:
+                                        yield ChatResponse.model_construct(content=pending_text)
+                                        pending_text = ""
+                                    continue
+
+                                if pending_text:
+                                    yield ChatResponse.model_construct(content=pending_text)
+                                    pending_text = ""
+                                yield ChatResponse(file_info=payload)
+
+                            if pending_text:
+                                yield ChatResponse.model_construct(content=pending_text)
+
+                            deadline.reschedule(loop.time() + config.response_timeout_seconds)
+
+                    usage = web_handler.usage
+                    run_status = web_handler.run_status
+                    incomplete_details = web_handler.incomplete_details
+
+                except asyncio.TimeoutError:
+                    yield ChatResponse(error=f"Response timeout after {config.response_timeout_seconds} seconds")
+                except Exception as e:
+                    # cancel the run if it fails, without holding up the error response
+                    if web_handler.run_id:
+                        self._spawn_cleanup(self._cancel_run(agents_client, session_thread.id, web_handler.run_id))
+                    logger.error("❌ Error in agent stream: %s", e)
+                    span.set_attribute("error", True)
+                    span.set_attribute("error_message", str(e))
+                    yield ChatResponse(error=str(e))
                 finally:
-                    # Ensure the stream task is properly cleaned up
-                    if stream_task and not stream_task.done():
-                        stream_task.cancel()
-                        with contextlib.suppress(asyncio.CancelledError):
-                            await stream_task
-
-                    # Clean up any remaining items in the queue to prevent memory leaks
-                    if web_handler:
-                        remaining_items = web_handler.get_queue_size()
-                        if remaining_items > 0:
-                            logger.info("🧹 Cleaning up %d remaining items in token queue", remaining_items)
-                        await web_handler.cleanup()
+                    # Clean up any remaining items to prevent memory leaks
+                    remaining_items = web_handler.pending_count()
+                    if remaining_items > 0:
+                        logger.info("🧹 Dropping %d undelivered stream items", remaining_items)
+                    web_handler.cleanup()
 
                 # Send completion signal
                 if usage:
                     yield ChatResponse(
-                        content=f"</br></br>Token usage: Prompt: {usage.prompt_tokens}, Completion: {usage.completion_tokens}, Total: {usage.total_tokens}"
+                        content=_USAGE_FMT(usage.prompt_tokens, usage.completion_tokens, usage.total_tokens)
                     )
                 if incomplete_details:
                     yield ChatResponse(content=f"</br>{incomplete_details.reason}")
@@ -41,6 +41,11 @@ class Config:
         # Chat/Response timeout settings
         self._response_timeout_seconds = 60
 
+        # Session thread cache settings ("lru" or "counter" eviction). Counter eviction avoids
+        # reordering the cache on every hit but favours frequently used sessions over recent ones.
+        self._max_sessions = 256
+        self._session_eviction_policy = "lru"
+
         # Compute dev tunnel URL
         self._dev_tunnel_url: str = self._compute_dev_tunnel_url()
 
@@ -155,6 +160,16 @@ class Config:
         """Returns the response timeout in seconds."""
         return self._response_timeout_seconds
 
+    @property
+    def max_sessions(self) -> int:
+        """Returns the maximum number of cached session threads."""
+        return self._max_sessions
+
+    @property
+    def session_eviction_policy(self) -> str:
+        """Returns the session thread eviction policy ("lru" or "counter")."""
+        return self._session_eviction_policy
+
     class Rls:
         """RLS configuration for PostgreSQL Row Level Security."""
 
@@ -1,6 +1,6 @@
-import asyncio
 import logging
 import re
+from enum import IntEnum
 
 from azure.ai.agents.aio import AgentsClient
 from azure.ai.agents.models import (
@@ -19,6 +19,13 @@ from utilities import Utilities
 logger = logging.getLogger(__name__)
 
 
+class StreamItemType(IntEnum):
+    """Kinds of items produced for the web client."""
+
+    TEXT = 0
+    FILE = 1
+
+
 class WebStreamEventHandler(AsyncAgentEventHandler[str]):
     """Handle LLM streaming events and tokens for web interface output."""
 
@@ -30,8 +37,10 @@ class WebStreamEventHandler(AsyncAgentEventHandler[str]):
         self.agents_client = agents_client
         self.util = utilities
         self.assistant_message = ""
-        self.token_queue: asyncio.Queue = asyncio.Queue()
-        self._is_closed = False
+        # Items produced by the callbacks since the last drain by the chat generator
+        self.pending_items: list[tuple[StreamItemType, str | dict]] = []
+        # Total length of the text items in pending_items
+        self.pending_text_size = 0
         self.run_id: str | None = None
         self.run_status: str | None = None
         self.usage: RunCompletionUsage | None = None
@@ -42,46 +51,36 @@ class WebStreamEventHandler(AsyncAgentEventHandler[str]):
         # Maximum buffer size to prevent memory issues
         self.max_buffer_size = 1000
 
-    async def cleanup(self) -> None:
-        """Clean up resources and drain the queue."""
-        if self._is_closed:
-            return
-
-        self._is_closed = True
-        # Clear the text buffer
+    def cleanup(self) -> None:
+        """Clean up resources and drop any undelivered items."""
         self.text_buffer = ""
-
-        # Drain any remaining items in the queue
-        try:
-            while not self.token_queue.empty():
-                try:
-                    self.token_queue.get_nowait()
-                except asyncio.QueueEmpty:
-                    break
-        except Exception as e:
-            logger.error("Error during WebStreamEventHandler cleanup: %s", e)
-
-    async def put_safely(self, item: dict | str | None) -> bool:
-        """Safely put an item in the queue, handling closed state."""
-        if self._is_closed:
-            return False
-        try:
-            await self.token_queue.put(item)
-            return True
-        except Exception as e:
-            logger.warning("Failed to put item in queue: %s", e)
-            return False
-
-    def get_queue_size(self) -> int:
-        """Get the current size of the token queue."""
-        try:
-            return self.token_queue.qsize()
-        except Exception:
-            return 0
-
-    def is_closed(self) -> bool:
-        """Check if the handler has been closed."""
-        return self._is_closed
+        self.pending_items = []
+        self.pending_text_size = 0
+
+    def put_item(self, item: tuple[StreamItemType, str | dict]) -> None:
+        """Add an item for the chat generator to send to the web client."""
+        if item[0] is StreamItemType.TEXT:
+            self.pending_text_size += len(item[1])
+        self.pending_items.append(item)
+
+    def drain(self) -> list[tuple[StreamItemType, str | dict]]:
+        """Return and clear the items added since the last drain."""
+        items = self.pending_items
+        self.pending_items = []
+        self.pending_text_size = 0
+        return items
+
+    def has_buffered_event(self) -> bool:
+        """Check whether the SDK has already received a complete event that can be processed without waiting."""
+        # Relies on internals of BaseAsyncAgentEventHandler in azure-ai-agents 1.2.0b4: `buffer` holds the
+        # unparsed response bytes and events end with a blank line. If a later SDK version changes this,
+        # report no buffered event so streaming still works, just without batching.
+        buffer = getattr(self, "buffer", None)
+        return isinstance(buffer, bytes) and b"\n\n" in buffer
+
+    def pending_count(self) -> int:
+        """Get the number of items waiting to be drained."""
+        return len(self.pending_items)
 
     async def _process_buffered_text(self) -> None:
         """Process buffered text, filtering out complete markdown image and link patterns."""
@@ -97,7 +96,7 @@ class WebStreamEventHandler(AsyncAgentEventHandler[str]):
 
             # Send the filtered text if there's any content left
             if filtered_text:
-                await self.put_safely({"type": "text", "content": filtered_text})
+                self.put_item((StreamItemType.TEXT, filtered_text))
 
             # Clear the buffer since we processed complete patterns
             self.text_buffer = ""
@@ -129,16 +128,16 @@ class WebStreamEventHandler(AsyncAgentEventHandler[str]):
                 self.text_buffer = self.text_buffer[partial_start_idx:]
 
                 if text_to_send:
-                    await self.put_safely({"type": "text", "content": text_to_send})
+                    self.put_item((StreamItemType.TEXT, text_to_send))
             else:
                 # No potential patterns, send all buffered text
-                await self.put_safely({"type": "text", "content": self.text_buffer})
+                self.put_item((StreamItemType.TEXT, self.text_buffer))
                 self.text_buffer = ""
 
         # Prevent buffer from growing too large
         if len(self.text_buffer) > self.max_buffer_size:
             # Send the buffer content and reset to prevent memory issues
-            await self.put_safely({"type": "text", "content": self.text_buffer})
+            self.put_item((StreamItemType.TEXT, self.text_buffer))
             self.text_buffer = ""
 
     async def on_message_delta(self, delta: MessageDeltaChunk) -> None:
@@ -161,7 +160,7 @@ class WebStreamEventHandler(AsyncAgentEventHandler[str]):
         if files:
             for file_info in files:
                 # logger.debug("Sending file info: %s", file_info)
-                await self.put_safely({"type": "file", "file_info": file_info})
+                self.put_item((StreamItemType.FILE, file_info))
 
     async def on_thread_run(self, run: ThreadRun) -> None:
         """Handle thread run events"""
@@ -195,7 +194,7 @@ class WebStreamEventHandler(AsyncAgentEventHandler[str]):
             # For final flush, remove any markdown images and links but send remaining content
             filtered_text = self.markdown_pattern.sub("", self.text_buffer)
             if filtered_text:
-                await self.put_safely({"type": "text", "content": filtered_text})
+                self.put_item((StreamItemType.TEXT, filtered_text))
             self.text_buffer = ""
 
     async def on_unhandled_event(self, event_type: str, event_data: object) -> None: